@@ -1,8 +1,10 @@
 import os
 import time
 from flask import Flask, render_template, request, make_response, jsonify
-from flask_socketio import SocketIO, emit
-import random, string, collections
+from flask_socketio import SocketIO, emit, join_room, leave_room
+import random, string, collections, threading, statistics, hashlib, uuid, re, json, resource
+from fastcups_state import store_from_url
+from concurrent.futures import ThreadPoolExecutor
 from fastcore.utils import *
 from urllib.parse import urlparse
 import google.generativeai as genai
@@ -11,10 +13,49 @@ from werkzeug.utils import secure_filename
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads/'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16 MB limit
-socketio = SocketIO(app)
-sid2student, student2color, class2students = dict(), dict(), collections.defaultdict(lambda: set())
-class2slides = {}
-class2questions = collections.defaultdict(list)
+# Set FASTCUPS_STATE_URL and FASTCUPS_MESSAGE_QUEUE to the same redis:// URL to serve a class from several workers
+socketio = SocketIO(app, message_queue=os.environ.get('FASTCUPS_MESSAGE_QUEUE'))
+store = store_from_url(os.environ.get('FASTCUPS_STATE_URL'))
+sid2student, student2color, class2students = store.dict('sid2student'), store.dict('student2color'), store.setdict('class2students')
+class2slides = store.dict('class2slides')
+class2questions = store.listdict('class2questions')
+
+ANSWER_WORKERS = int(os.environ.get('FASTCUPS_ANSWER_WORKERS', 8))
+ANSWERS_PER_CLASS = int(os.environ.get('FASTCUPS_ANSWERS_PER_CLASS', 2))
+MAX_PENDING_ANSWERS = int(os.environ.get('FASTCUPS_MAX_PENDING_ANSWERS', 256))
+ANSWER_TIMEOUT = float(os.environ.get('FASTCUPS_ANSWER_TIMEOUT', 120))
+answer_pool = ThreadPoolExecutor(max_workers=ANSWER_WORKERS, thread_name_prefix='answer')
+# per-class FIFO of (key, question, deadline) waiting for one of the class's `ANSWERS_PER_CLASS` slots
+class2answer_queue, class2running, dispatch_lock = collections.defaultdict(collections.deque), collections.Counter(), threading.Lock()
+pending_answers, pending_lock = [0], threading.Lock()
+stats = collections.Counter()
+upload_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('FASTCUPS_UPLOAD_WORKERS', 4)), thread_name_prefix='upload')
+# jobs are shared so any worker can answer a status poll; in-flight uploads (sha2job) belong to the worker running them
+jobs, sha2file, sha2job, upload_lock = store.dict('jobs'), dict(), dict(), threading.Lock()
+loop_lag = collections.deque(maxlen=1000)
+# opt-in: also coalesce questions that only differ in stopwords
+FUZZY_QUESTIONS = os.environ.get('FASTCUPS_FUZZY_QUESTIONS', '0') == '1'
+STOPWORDS = set('a an the is are was were be been am do does did of to in on at for it its this that these those '
+                'please can could would will you me i we us so just again here there about'.split())
+NEGATIONS = {'not', 'no', 'never', 'nor', 'cannot', 't'}
+ANSWER_CACHE_PER_CLASS = int(os.environ.get('FASTCUPS_ANSWER_CACHE_PER_CLASS', 256))
+class2inflight, class2answer_cache = collections.defaultdict(dict), collections.defaultdict(collections.OrderedDict)
+class2stats, coalesce_lock = collections.defaultdict(collections.Counter), threading.Lock()
+DASHBOARD_UPDATES_PER_SEC = float(os.environ.get('FASTCUPS_DASHBOARD_UPDATES_PER_SEC', 2))
+student2class, dirty_classes = store.dict('student2class'), set()
+name2file = dict()
+GEMINI_FILE_TTL = 48 * 3600
+SLIDES_REUSE_MARGIN = float(os.environ.get('FASTCUPS_SLIDES_REUSE_MARGIN', 6 * 3600))
+app.config['ARCHIVE_FOLDER'] = os.environ.get('FASTCUPS_ARCHIVE_FOLDER', 'archive/')
+MAX_QUESTIONS_PER_CLASS = int(os.environ.get('FASTCUPS_MAX_QUESTIONS_PER_CLASS', 500))
+CLASS_IDLE_TTL = float(os.environ.get('FASTCUPS_CLASS_IDLE_TTL', 4 * 3600))
+EVICT_INTERVAL = float(os.environ.get('FASTCUPS_EVICT_INTERVAL', 60))
+student2sids, class2last_active = store.setdict('student2sids'), store.dict('class2last_active')
+questions_lock = threading.Lock()
+# Only the archive worker archives questions and evicts shared class state, so the archive lives on one host; other
+# workers only drop their own per-process caches. On by default for a single worker; with FASTCUPS_STATE_URL set,
+# set FASTCUPS_ARCHIVE_WORKER=1 on exactly one worker.
+ARCHIVE_WORKER = os.environ.get('FASTCUPS_ARCHIVE_WORKER', '0' if os.environ.get('FASTCUPS_STATE_URL') else '1') == '1'
 
 genai.configure(api_key=os.environ["GEMINI_API_KEY"])
 
@@ -23,13 +64,35 @@ def upload_to_gemini(path, mime_type=None):
     print(f"Uploaded file '{file.display_name}' as: {file.uri}")
     return file
 
-def wait_for_files_active(files):
+def file_expiry(file):
+    "When Gemini deletes an upload: its `expiration_time`, else `GEMINI_FILE_TTL` from now"
+    expiration = getattr(file, 'expiration_time', None)
+    return expiration.timestamp() if expiration else time.time() + GEMINI_FILE_TTL
+
+def reusable_slides(sha):
+    "The file already uploaded with this content, if Gemini still has it ACTIVE and it won't expire within `SLIDES_REUSE_MARGIN`"
+    with upload_lock: file = sha2file.get(sha)
+    if file is None: return None
+    try: ok = file_expiry(file) - time.time() > SLIDES_REUSE_MARGIN and genai.get_file(file.name).state.name == 'ACTIVE'
+    except Exception: ok = False
+    if not ok:
+        with upload_lock: sha2file.pop(sha, None)
+        return None
+    return file
+
+def gemini_file(name):
+    "`class2slides` holds file names so any worker can share it; the `File` objects are cached per process"
+    if name not in name2file: name2file[name] = genai.get_file(name)
+    return name2file[name]
+
+def wait_for_files_active(files, delay=1, max_delay=10, backoff=2):
     print("Waiting for file processing...")
     for name in (file.name for file in files):
-        file = genai.get_file(name)
+        file, wait = genai.get_file(name), delay
         while file.state.name == "PROCESSING":
             print(".", end="", flush=True)
-            time.sleep(10)
+            time.sleep(wait)
+            wait = min(wait * backoff, max_delay)
             file = genai.get_file(name)
         if file.state.name != "ACTIVE":
             raise Exception(f"File {file.name} failed to process")
@@ -53,16 +116,35 @@ model = genai.GenerativeModel(
 def root(): 
     return render_template('howto.html', url=f'https://{urlparse(request.base_url).hostname}')
 
+@app.route('/metrics')
+def metrics():
+    lag = sorted(loop_lag) or [0.]
+    return jsonify({**stats, "pending_answers": pending_answers[0], "async_mode": socketio.async_mode,
+        "loop_lag_ms": {"p50": 1000*statistics.median(lag), "p99": 1000*lag[int(.99*(len(lag)-1))], "max": 1000*lag[-1]},
+        "entries": state_gauges(), "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+def state_gauges():
+    return {"sid2student": len(sid2student), "student2color": len(student2color), "student2class": len(student2class),
+            "classes": len(class2last_active), "class2students": len(class2students), "class2slides": len(class2slides),
+            "class2questions": len(class2questions), "questions": sum(len(class2questions[c]) for c in list(class2questions)),
+            "answer_cache": sum(len(o) for o in list(class2answer_cache.values())), "jobs": len(jobs)}
+
 @app.route('/<class_id>')
 def student_interface(class_id):
     student_id = request.cookies.get('student_id') or ''.join(random.choices(string.ascii_letters, k=12))
+    touch(class_id)
     class2students[class_id].add(student_id)
     response = make_response(render_template('student.html', timestamp=time.time(), class_id=class_id))
     response.set_cookie('student_id', student_id)
     return response
 
+@app.route('/<class_id>/metrics')
+def class_metrics(class_id):
+    return jsonify(class2stats.get(class_id, {}))
+
 @app.route('/<class_id>/teacher')
 def teacher_interface(class_id):
+    touch(class_id)
     return render_template('teacher.html', student_count=student_count(class_id),
         active_student_count=active_student_count(class_id), color2frac=color_fraction(class_id))
 
@@ -74,81 +156,330 @@ def upload_slides(class_id):
     if file.filename == '':
         return jsonify({"error": "No selected file"}), 400
     if file and file.filename.lower().endswith('.pdf'):
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
-        uploaded_file = upload_to_gemini(file_path, mime_type="application/pdf")
-        wait_for_files_active([uploaded_file])
-        class2slides[class_id] = uploaded_file
-        return jsonify({"message": "File uploaded successfully"}), 200
+        data = file.read()
+        sha = hashlib.sha256(data).hexdigest()
+        job_id = uuid.uuid4().hex
+        touch(class_id)
+        reusable = reusable_slides(sha)
+        with upload_lock:
+            job = {"class_id": class_id, "sha256": sha, "status": "processing", "error": None, "created": time.time()}
+            if reusable is not None:
+                stats['uploads_deduped'] += 1
+                jobs[job_id] = {**job, "status": "ready"}
+                set_slides(class_id, reusable)
+                return jsonify({"message": "File uploaded successfully", "job_id": job_id, "status": "ready"}), 200
+            jobs[job_id] = job
+            if sha in sha2job: sha2job[sha][1].append(job_id)
+            else:
+                sha2job[sha] = (upload_pool.submit(process_slides, sha, data, secure_filename(file.filename)), [job_id])
+        return jsonify({"message": "File accepted for processing", "job_id": job_id, "status": "processing"}), 202
     else:
         return jsonify({"error": "Invalid file type. Please upload a PDF."}), 400
 
+@app.route('/<class_id>/upload_slides/<job_id>')
+def upload_status(class_id, job_id):
+    job = jobs.get(job_id)
+    if job is None or job['class_id'] != class_id:
+        return jsonify({"error": "Unknown job"}), 404
+    return jsonify({"job_id": job_id, **job}), 200
+
+def process_slides(sha, data, filename):
+    "Runs on `upload_pool`; uploads one PDF to Gemini and hands it to every job waiting on the same content"
+    try:
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{sha[:16]}-{filename}")
+        with open(file_path, 'wb') as f: f.write(data)
+        uploaded_file = upload_to_gemini(file_path, mime_type="application/pdf")
+        wait_for_files_active([uploaded_file])
+        status, error = 'ready', None
+    except Exception as e:
+        print(f"Processing slides {sha} failed: {e}")
+        uploaded_file, status, error = None, 'failed', str(e)
+    with upload_lock:
+        if uploaded_file is not None: sha2file[sha] = uploaded_file
+        for job_id in sha2job.pop(sha)[1]:
+            job = {**jobs[job_id], "status": status, "error": error}
+            jobs[job_id] = job
+            if uploaded_file is not None: set_slides(job['class_id'], uploaded_file)
+            else: socketio.emit('slides_failed', {"job_id": job_id, "error": error}, room=job['class_id'])
+
+def set_slides(class_id, uploaded_file):
+    with coalesce_lock:
+        name2file[uploaded_file.name] = uploaded_file
+        class2slides[class_id] = uploaded_file.name
+        class2answer_cache.pop(class_id, None)
+    socketio.emit('slides_ready', {"name": uploaded_file.display_name}, room=class_id)
+
+def student_room(student_id): return f'student:{student_id}'
+def teacher_room(class_id): return f'teacher:{class_id}'
+
 @socketio.on('register_student')
 def register_student(timestamp, class_id):
     student_id = request.cookies.get('student_id')
     emit('deactivate_old_tabs', 
-            {'student_id':  student_id, 'timestamp': timestamp}, broadcast=True, namespace='/')
+            {'student_id':  student_id, 'timestamp': timestamp}, room=student_room(student_id))
+    join_room(student_room(student_id))
+    join_room(class_id)
+    touch(class_id)
     student2color[student_id] = 'inactive'
     sid2student[request.sid] = student_id
-    for cls in class2students:
-        class2students[cls].discard(student_id)
+    student2sids[student_id].add(request.sid)
+    old_class = student2class.get(student_id)
+    if old_class is not None and old_class != class_id:
+        class2students[old_class].discard(student_id)
+        leave_room(old_class)
+        dirty_classes.add(old_class)
+    student2class[student_id] = class_id
     class2students[class_id].add(student_id)
+    dirty_classes.add(class_id)
+
+@socketio.on('register_teacher')
+def register_teacher(class_id):
+    touch(class_id)
+    join_room(class_id)
+    join_room(teacher_room(class_id))
+    emit('dashboard_update', dashboard(class_id))
 
 @socketio.on('color_change')
 def handle_color_change(new_color): 
-    student2color[request.cookies['student_id']] = new_color
+    student_id = request.cookies['student_id']
+    student2color[student_id] = new_color
+    if student_id in student2class: dirty_classes.add(student2class[student_id])
 
 @socketio.on('disconnect')
 def handle_disconnect():
     student = sid2student.pop(request.sid, None)
+    if student is None: return
+    class_id = student2class.get(student)
+    if class_id is not None: dirty_classes.add(class_id)
+    sids = student2sids[student]
+    sids.discard(request.sid)
+    if not sids: forget_student(student, class_id)
+
+def forget_student(student, class_id):
+    "Drops everything kept about a student once their last tab disconnects"
+    student2sids.pop(student, None)
+    student2color.pop(student, None)
+    student2class.pop(student, None)
+    if class_id is not None and class_id in class2students: class2students[class_id].discard(student)
+
+def touch(class_id): class2last_active[class_id] = time.time()
+
+def evict_idle_classes():
+    "Forgets classes idle for `CLASS_IDLE_TTL` with nobody connected, archiving their questions first"
+    while True:
+        socketio.sleep(EVICT_INTERVAL)
+        evict_idle(time.time() - CLASS_IDLE_TTL)
+
+def evict_idle(cutoff):
+    connected = set(sid2student.values())
+    classes = set(class2last_active) | set(class2students) | set(class2questions) | set(class2slides) | set(class2stats)
+    for class_id in classes:
+        if class2last_active.get(class_id, 0) > cutoff or class2inflight.get(class_id) or class2running[class_id]: continue
+        if class_id in class2students and any(s in connected for s in class2students[class_id]): continue
+        evict_class(class_id)
+    if ARCHIVE_WORKER:
+        with questions_lock:
+            for class_id in list(class2questions):
+                if len(class2questions[class_id]) > MAX_QUESTIONS_PER_CLASS: archive_questions(class_id, MAX_QUESTIONS_PER_CLASS // 2)
+    with upload_lock:
+        for job_id in [k for k, job in jobs.items() if job['status'] != 'processing' and job['created'] < cutoff]:
+            del jobs[job_id]
+        for sha in [k for k, file in sha2file.items() if file_expiry(file) - time.time() < SLIDES_REUSE_MARGIN]:
+            del sha2file[sha]
+    for name in [k for k, file in list(name2file.items()) if file_expiry(file) < time.time()]:
+        name2file.pop(name, None)
+
+def evict_class(class_id):
+    if ARCHIVE_WORKER:
+        with questions_lock:
+            if class_id in class2questions: archive_questions(class_id, 0)
+            class2questions.pop(class_id, None)
+        for o in (class2students, class2slides, class2last_active): o.pop(class_id, None)
+    with coalesce_lock:
+        for o in (class2answer_cache, class2inflight, class2stats): o.pop(class_id, None)
+    stats['classes_evicted'] += 1
+
+def archive_questions(class_id, keep):
+    "Drops all but the newest `keep` questions in one step of the store and appends them to the class archive"
+    first, archived = class2questions[class_id].trim_front(keep)
+    if not archived: return
+    os.makedirs(app.config['ARCHIVE_FOLDER'], exist_ok=True)
+    with open(os.path.join(app.config['ARCHIVE_FOLDER'], f"{secure_filename(class_id) or 'class'}.jsonl"), 'a') as f:
+        for i, q in enumerate(archived): f.write(json.dumps({"index": first + i, **q}) + '\n')
+    stats['questions_archived'] += len(archived)
+
+def dashboard(class_id):
+    return {"student_count": student_count(class_id), "active_student_count": active_student_count(class_id),
+            "color2frac": color_fraction(class_id)}
+
+def flush_dashboards():
+    "Pushes at most `DASHBOARD_UPDATES_PER_SEC` dashboard updates per class, however many color changes arrive"
+    while True:
+        socketio.sleep(1 / DASHBOARD_UPDATES_PER_SEC)
+        flush_dirty_dashboards()
+
+def flush_dirty_dashboards():
+    while dirty_classes:
+        class_id = dirty_classes.pop()
+        socketio.emit('dashboard_update', dashboard(class_id), room=teacher_room(class_id))
 
 @socketio.on('submit_question')
 def handle_question(class_id, question):
-    if class_id in class2slides:
-        chat_session = model.start_chat(history=[{"role": "user", "parts": [class2slides[class_id]]}])
-        response = chat_session.send_message(question)
-        class2questions[class_id].append({
-            "question": question,
-            "answer": response.text,
-            "status": "pending"
-        })
-        emit('new_question', {"question": question, "answer": response.text}, room=class_id)
-    else:
-        class2questions[class_id].append({
-            "question": question,
-            "answer": None,
-            "status": "pending"
-        })
-        emit('new_question', {"question": question, "answer": None}, room=class_id)
+    touch(class_id)
+    with questions_lock:
+        questions = class2questions[class_id]
+        index = questions.append({"question": question, "answer": None, "status": "pending", "answer_status": "pending"})
+        if ARCHIVE_WORKER and len(questions) > MAX_QUESTIONS_PER_CLASS: archive_questions(class_id, MAX_QUESTIONS_PER_CLASS // 2)
+    emit('new_question', {"index": index, "question": question, "answer": None, "answer_status": "pending"}, room=class_id)
+    slides = class2slides.get(class_id)
+    if slides is None: return finish_answer(class_id, [index], None, 'no_slides')
+    class2stats[class_id]['questions'] += 1
+    # the answer cache is per worker while slides are shared, so the deck is part of the key: another worker
+    # uploading new slides can't clear this one's cache, but it does stop old answers from matching
+    key = slides, question_key(question)
+    done = None
+    with coalesce_lock:
+        cache, inflight = class2answer_cache[class_id], class2inflight[class_id]
+        if key in cache:
+            cache.move_to_end(key)
+            class2stats[class_id]['answers_cached'] += 1
+            done = cache[key], 'answered'
+        elif key in inflight:
+            class2stats[class_id]['answers_coalesced'] += 1
+            return inflight[key].append(index)
+        else:
+            with pending_lock:
+                if pending_answers[0] >= MAX_PENDING_ANSWERS:
+                    stats['answers_rejected'] += 1
+                    done = None, 'busy'
+                else:
+                    pending_answers[0] += 1
+                    inflight[key] = [index]
+    # emits can be network publishes with a message queue, so they happen outside `coalesce_lock`
+    if done: return finish_answer(class_id, [index], *done)
+    with dispatch_lock: class2answer_queue[class_id].append((key, question, time.monotonic() + ANSWER_TIMEOUT))
+    dispatch_answers(class_id)
+
+def dispatch_answers(class_id):
+    "Hands queued questions to `answer_pool` only while the class has a free slot, so a busy class can't fill the pool"
+    with dispatch_lock:
+        queued = class2answer_queue[class_id]
+        while queued and class2running[class_id] < ANSWERS_PER_CLASS:
+            class2running[class_id] += 1
+            answer_pool.submit(answer_question, class_id, *queued.popleft())
+        if not queued: class2answer_queue.pop(class_id, None)
+        if not class2running[class_id]: del class2running[class_id]
+
+def normalize_question(question):
+    return ' '.join(re.sub(r'[^\w\s]', ' ', re.sub(r"n't\b", ' not', question.lower())).split())
+
+def question_key(question):
+    """
+    Questions with the same key share one answer. By default that is the normalized text; with `FUZZY_QUESTIONS` it is
+    the words left after dropping stopwords, in order and with negations kept, so "not quadratic", "min"/"max",
+    "tree"/"trie" or "A faster than B"/"B faster than A" never meet.
+    """
+    words = normalize_question(question).split()
+    if not FUZZY_QUESTIONS: return ' '.join(words)
+    return ' '.join('not' if w in NEGATIONS else w for w in words if w not in STOPWORDS)
+
+def answer_question(class_id, key, question, deadline):
+    "Runs on `answer_pool`; streams one Gemini answer to every coalesced copy of the question"
+    answer = ''
+    try:
+        indices, slides = class2inflight[class_id][key], key[0]
+        if time.monotonic() > deadline: raise TimeoutError(f"question waited more than {ANSWER_TIMEOUT}s")
+        chat_session = model.start_chat(history=[{"role": "user", "parts": [gemini_file(slides)]}])
+        stats['llm_calls'] += 1
+        class2stats[class_id]['llm_calls'] += 1
+        for chunk in chat_session.send_message(question, stream=True,
+                                               request_options={"timeout": max(deadline - time.monotonic(), 1)}):
+            answer += chunk.text
+            for index in list(indices):
+                socketio.emit('answer_chunk', {"index": index, "text": chunk.text}, room=class_id)
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"answer exceeded {ANSWER_TIMEOUT}s")
+        stats['answers_ok'] += 1
+        with coalesce_lock:
+            if class2slides.get(class_id) == slides: cache_answer(class_id, key, answer)
+        finish_answer(class_id, take_inflight(class_id, key), answer, 'answered')
+    except TimeoutError:
+        stats['answers_timeout'] += 1
+        finish_answer(class_id, take_inflight(class_id, key), answer or None, 'timeout')
+    except Exception as e:
+        print(f"Answering {question!r} in {class_id} failed: {e}")
+        stats['answers_error'] += 1
+        finish_answer(class_id, take_inflight(class_id, key), answer or None, 'error')
+    finally:
+        with pending_lock: pending_answers[0] -= 1
+        with dispatch_lock: class2running[class_id] -= 1
+        dispatch_answers(class_id)
+
+def cache_answer(class_id, key, answer):
+    "Keeps the `ANSWER_CACHE_PER_CLASS` most recently used answers; callers hold `coalesce_lock`"
+    cache = class2answer_cache[class_id]
+    cache[key] = answer
+    cache.move_to_end(key)
+    while len(cache) > ANSWER_CACHE_PER_CLASS: cache.popitem(last=False)
+
+def take_inflight(class_id, key):
+    with coalesce_lock: return class2inflight[class_id].pop(key, [])
+
+def finish_answer(class_id, indices, answer, answer_status):
+    for index in indices:
+        update_question(class_id, index, answer=answer, answer_status=answer_status)
+        socketio.emit('answer_ready', {"index": index, "answer": answer, "answer_status": answer_status}, room=class_id)
+
+def monitor_loop_lag(interval=0.1):
+    """
+    Records how late the server's event loop wakes up, so a handler blocking it shows up as lag. That only holds under
+    eventlet or gevent: in threading mode each handler has its own thread and this gauge stays near zero, so use the
+    acknowledgement latencies from `fastcups_bench.py lecture` there.
+    """
+    while True:
+        start = time.monotonic()
+        socketio.sleep(interval)
+        loop_lag.append(max(time.monotonic() - start - interval, 0.))
 
 @socketio.on('mark_question_solved')
 def mark_question_solved(class_id, question_index):
-    if 0 <= question_index < len(class2questions[class_id]):
-        class2questions[class_id][question_index]['status'] = 'solved'
+    if update_question(class_id, question_index, status='solved'):
         emit('question_status_update', {"index": question_index, "status": "solved"}, room=class_id)
 
 @socketio.on('submit_to_speaker')
 def submit_to_speaker(class_id, question_index):
-    if 0 <= question_index < len(class2questions[class_id]):
-        class2questions[class_id][question_index]['status'] = 'submitted'
+    if update_question(class_id, question_index, status='submitted'):
         emit('question_status_update', {"index": question_index, "status": "submitted"}, room=class_id)
 
+def update_question(class_id, index, **kwargs):
+    "Updates the question with that index in one step of the store; False if unknown or archived"
+    with questions_lock:
+        return class_id in class2questions and class2questions[class_id].update(index, **kwargs)
+
 def student_count(class_id): 
-    return L(sid2student.values()).filter(lambda s: s in class2students[class_id]).count()
+    students = set(class2students[class_id])
+    return L(sid2student.values()).filter(lambda s: s in students).count()
 
 def connected_student2color(class_id):
-    return {k: v for k, v in student2color.items() if (k in class2students[class_id]) and (k in sid2student.values())}
+    connected, students = set(sid2student.values()), set(class2students[class_id])
+    return {k: v for k, v in student2color.items() if (k in students) and (k in connected)}
 
 def active_student_count(class_id):
     return L(connected_student2color(class_id).values()).filter(lambda c: c != 'inactive').count()
 
 def color_fraction(class_id):
-    return {color: L(connected_student2color(class_id).values()).map(eq(color)).sum()/(active_student_count(class_id) or 1)
-            for color in ['green', 'yellow', 'red']}
+    colors = L(connected_student2color(class_id).values())
+    active = colors.filter(lambda c: c != 'inactive').count() or 1
+    return {color: colors.map(eq(color)).sum()/active for color in ['green', 'yellow', 'red']}
 
 @patch
 def count(self:L): return len(self)
 
+def start_background_tasks():
+    socketio.start_background_task(monitor_loop_lag)
+    socketio.start_background_task(flush_dashboards)
+    socketio.start_background_task(evict_idle_classes)
+
 if __name__ == '__main__':
-    socketio.run(app, debug=False, host='0.0.0.0')
+    start_background_tasks()
+    socketio.run(app, debug=False, host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,212 @@
+import os, sys, time, json, socket, random, asyncio, argparse, subprocess, collections, urllib.request
+from types import SimpleNamespace
+os.environ.setdefault("GEMINI_API_KEY", "bench")
+
+QUESTIONS = ["What does this slide mean?", "Can you explain the second equation?", "Why is the complexity quadratic?",
+             "What is the difference between the two approaches?", "Could you repeat the definition?"]
+COLORS = ['green', 'yellow', 'red']
+
+class StubChat:
+    "Stands in for a Gemini chat session: streams a canned answer over `latency` seconds"
+    def __init__(self, latency): self.latency = latency
+    def send_message(self, question, stream=False, request_options=None):
+        words = f"Stub answer to: {question}".split()
+        for word in words:
+            time.sleep(self.latency / len(words))
+            yield SimpleNamespace(text=word + ' ')
+
+class StubModel:
+    def __init__(self, latency): self.latency = latency
+    def start_chat(self, history): return StubChat(self.latency)
+
+def serve(port, n_classes, llm_latency):
+    "Runs fastcups with Gemini stubbed out and slides preloaded for classes `bench-0`..`bench-{n_classes-1}`"
+    import fastcups
+    fastcups.model = StubModel(llm_latency)
+    fastcups.name2file['files/bench'] = 'bench slides'
+    for i in range(n_classes): fastcups.class2slides[f'bench-{i}'] = 'files/bench'
+    fastcups.start_background_tasks()
+    fastcups.socketio.run(fastcups.app, host='127.0.0.1', port=port, allow_unsafe_werkzeug=True)
+
+def connect(student_id):
+    from fastcups import app, socketio
+    return socketio.test_client(app, headers={'Cookie': f'student_id={student_id}'})
+
+def received(clients):
+    return sum(len(c.get_received()) for c in clients)
+
+def bench_emits(n_students=1000, class_id='bench'):
+    "Counts Socket.IO messages delivered per event with `n_students` connected to one class"
+    import fastcups
+    students = [connect(f's{i}') for i in range(n_students)]
+    teacher = connect('teacher')
+    for c in students: c.emit('register_student', time.time(), class_id)
+    teacher.emit('register_teacher', class_id)
+    received(students + [teacher])
+
+    late = connect('s0')
+    late.emit('register_student', time.time(), class_id)
+    print(f"register_student: {received(students + [teacher, late])} messages")
+
+    for i, c in enumerate(students): c.emit('color_change', COLORS[i % 3])
+    print(f"{n_students} x color_change: {received(students + [teacher, late])} messages before flush")
+    fastcups.flush_dirty_dashboards()
+    print(f"dashboard flush: {received(students + [teacher, late])} messages")
+    for c in students + [teacher, late]: c.disconnect()
+
+def start_workers(n_workers, base_port=5100, env=None, n_classes=1, llm_latency=2.):
+    "Starts `n_workers` stubbed fastcups processes on consecutive ports, the first archiving, and waits until they accept connections"
+    cmd = [sys.executable, __file__, 'serve', '--classes', str(n_classes), '--llm-latency', str(llm_latency)]
+    procs = [subprocess.Popen(cmd + ['--port', str(base_port+i)],
+                              env={**os.environ, **(env or {}), 'FASTCUPS_ARCHIVE_WORKER': '1' if i == 0 else '0'},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for i in range(n_workers)]
+    for port in range(base_port, base_port + n_workers):
+        for _ in range(300):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError: time.sleep(0.1)
+        else: raise RuntimeError(f"worker on port {port} did not start")
+    return procs, [f'http://127.0.0.1:{port}' for port in range(base_port, base_port + n_workers)]
+
+def stop_workers(procs):
+    for p in procs: p.terminate()
+    for p in procs: p.wait()
+
+async def connect_client(url, student_id, timeout=10):
+    import socketio as sio
+    c = sio.AsyncClient(reconnection=False)
+    await c.connect(url, headers={'Cookie': f'student_id={student_id}'}, transports=['websocket'], wait_timeout=timeout)
+    return c
+
+async def connect_clients(urls, n_clients, class_id='bench', concurrency=200, timeout=10):
+    "Connects and registers `n_clients` students round-robin across `urls`; returns (clients, register latencies, failures)"
+    sem, clients, latencies, failures = asyncio.Semaphore(concurrency), [], [], [0]
+    async def one(i):
+        async with sem:
+            try:
+                c = await connect_client(urls[i % len(urls)], f's{i}', timeout)
+                start = time.perf_counter()
+                await c.call('register_student', (time.time(), class_id), timeout=timeout)
+                latencies.append(time.perf_counter() - start)
+                clients.append(c)
+            except Exception: failures[0] += 1
+    await asyncio.gather(*(one(i) for i in range(n_clients)))
+    return clients, latencies, failures[0]
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(int(p/100 * len(xs)), len(xs)-1)] if xs else float('nan')
+
+async def bench_workers(worker_counts, n_clients, redis_url):
+    "Connection capacity of 1..N workers sharing state and a message queue through `redis_url`"
+    for n_workers in worker_counts:
+        procs, urls = start_workers(n_workers, env={'FASTCUPS_STATE_URL': redis_url, 'FASTCUPS_MESSAGE_QUEUE': redis_url})
+        try:
+            start = time.perf_counter()
+            clients, latencies, failures = await connect_clients(urls, n_clients)
+            elapsed = time.perf_counter() - start
+            print(f"{n_workers} workers: {len(clients)}/{n_clients} connected in {elapsed:.1f}s "
+                  f"({len(clients)/elapsed:.0f}/s), {failures} failed, register p50 {1000*percentile(latencies, 50):.1f}ms "
+                  f"p99 {1000*percentile(latencies, 99):.1f}ms")
+            await asyncio.gather(*(c.disconnect() for c in clients))
+        finally: stop_workers(procs)
+
+async def sample_process(pid, samples, interval=1.):
+    "Appends (elapsed s, cpu %, rss MB) for `pid` every `interval` seconds until cancelled"
+    import psutil
+    proc, start = psutil.Process(pid), time.perf_counter()
+    proc.cpu_percent()
+    while True:
+        await asyncio.sleep(interval)
+        samples.append((time.perf_counter() - start, proc.cpu_percent(), proc.memory_info().rss / 2**20))
+
+async def student(i, url, class_id, duration, ramp, action_rate, question_prob, churn_prob, latencies, failures, timeout=10):
+    "One simulated student: joins during the ramp, changes color / asks questions, sometimes drops and rejoins, then leaves"
+    async def timed(event, *args):
+        start = time.perf_counter()
+        try:
+            await c.call(event, args, timeout=timeout)
+            latencies[event].append(time.perf_counter() - start)
+        except Exception: failures[event] += 1
+    await asyncio.sleep(random.uniform(0, ramp))
+    end = time.perf_counter() + duration
+    try: c = await connect_client(url, f'{class_id}-s{i}', timeout)
+    except Exception: return failures.update(['connect'])
+    await timed('register_student', time.time(), class_id)
+    while time.perf_counter() < end:
+        await asyncio.sleep(random.expovariate(action_rate))
+        r = random.random()
+        if r < churn_prob:
+            start = time.perf_counter()
+            await c.disconnect()
+            latencies['disconnect'].append(time.perf_counter() - start)
+            try: c = await connect_client(url, f'{class_id}-s{i}', timeout)
+            except Exception: return failures.update(['connect'])
+            await timed('register_student', time.time(), class_id)
+        elif r < churn_prob + question_prob: await timed('submit_question', class_id, random.choice(QUESTIONS))
+        else: await timed('color_change', random.choice(COLORS))
+    start = time.perf_counter()
+    await c.disconnect()
+    latencies['disconnect'].append(time.perf_counter() - start)
+
+async def bench_lecture(args):
+    "Simulates a lecture against one stubbed fastcups process; returns False if a latency gate was exceeded"
+    procs, urls = start_workers(1, base_port=args.port, n_classes=args.classes, llm_latency=args.llm_latency)
+    latencies, failures, samples = collections.defaultdict(list), collections.Counter(), []
+    sampler = asyncio.create_task(sample_process(procs[0].pid, samples))
+    try:
+        await asyncio.gather(*(student(i, urls[0], f'bench-{i % args.classes}', args.duration, args.ramp, args.action_rate,
+                                       args.question_prob, args.churn_prob, latencies, failures)
+                               for i in range(args.students)))
+        await asyncio.sleep(2)
+        with urllib.request.urlopen(f'{urls[0]}/metrics') as r: server = json.load(r)
+    finally:
+        sampler.cancel()
+        stop_workers(procs)
+
+    print(f"{args.students} students in {args.classes} classes, {args.duration:.0f}s lecture")
+    ok = True
+    for event, xs in sorted(latencies.items()):
+        p50, p95, p99 = (1000*percentile(xs, p) for p in (50, 95, 99))
+        slow = args.max_p99_ms is not None and event != 'disconnect' and p99 > args.max_p99_ms
+        ok &= not slow
+        print(f"  {event:<16} n={len(xs):<7} p50 {p50:7.1f}ms  p95 {p95:7.1f}ms  p99 {p99:7.1f}ms{'  SLOW' if slow else ''}")
+    if failures: print(f"  failures: {dict(failures)}")
+    if samples:
+        cpu, rss = [s[1] for s in samples], [s[2] for s in samples]
+        print(f"  server cpu mean {sum(cpu)/len(cpu):.0f}% max {max(cpu):.0f}%, "
+              f"rss {rss[0]:.0f}MB -> {rss[-1]:.0f}MB (peak {max(rss):.0f}MB)")
+    print(f"  server after lecture: loop lag {server['loop_lag_ms']} ({server['async_mode']} mode), entries {server['entries']}")
+    return ok and (not failures or not args.fail_on_errors)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="fastcups Socket.IO benchmarks")
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    srv = sub.add_parser('serve', help="run fastcups with Gemini stubbed out")
+    srv.add_argument('--port', type=int, default=5100)
+    srv.add_argument('--classes', type=int, default=1)
+    srv.add_argument('--llm-latency', type=float, default=2.)
+    emits = sub.add_parser('emits', help="messages delivered per event")
+    emits.add_argument('--students', type=int, default=1000)
+    workers = sub.add_parser('workers', help="connection capacity vs number of worker processes")
+    workers.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    workers.add_argument('--clients', type=int, default=2000)
+    workers.add_argument('--redis', default='redis://localhost:6379/0')
+    lecture = sub.add_parser('lecture', help="load test: simulated students over a lecture, exits 1 on regressions")
+    lecture.add_argument('--port', type=int, default=5100)
+    lecture.add_argument('--students', type=int, default=2000)
+    lecture.add_argument('--classes', type=int, default=4)
+    lecture.add_argument('--duration', type=float, default=60., help="seconds each student stays")
+    lecture.add_argument('--ramp', type=float, default=10., help="seconds over which students join")
+    lecture.add_argument('--action-rate', type=float, default=0.2, help="actions per student per second")
+    lecture.add_argument('--question-prob', type=float, default=0.02)
+    lecture.add_argument('--churn-prob', type=float, default=0.01, help="chance an action is a disconnect and rejoin")
+    lecture.add_argument('--llm-latency', type=float, default=2.)
+    lecture.add_argument('--max-p99-ms', type=float, default=None, help="fail if any event's p99 exceeds this")
+    lecture.add_argument('--fail-on-errors', action='store_true')
+    args = parser.parse_args()
+    if args.cmd == 'serve': serve(args.port, args.classes, args.llm_latency)
+    elif args.cmd == 'emits': bench_emits(args.students)
+    elif args.cmd == 'workers': asyncio.run(bench_workers(args.workers, args.clients, args.redis))
+    else: sys.exit(0 if asyncio.run(bench_lecture(args)) else 1)
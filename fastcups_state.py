@@ -0,0 +1,119 @@
+import json, collections
+from collections.abc import MutableMapping, MutableSet, Sequence
+
+class MemoryList(list):
+    "A list that counts the items dropped from its front, so an item's index stays the same for its whole life"
+    dropped = 0
+    def append(self, v):
+        super().append(v)
+        return self.dropped + len(self) - 1
+    def update(self, index, **changes):
+        "Merges `changes` into the dict at `index`; False if there is no such item (any more)"
+        i = index - self.dropped
+        if not 0 <= i < len(self): return False
+        self[i] = {**self[i], **changes}
+        return True
+    def trim_front(self, keep):
+        "Drops all but the newest `keep` items; returns (index of the first dropped item, dropped items)"
+        n, first = max(len(self) - keep, 0), self.dropped
+        items = self[:n]
+        del self[:n]
+        self.dropped += n
+        return first, items
+
+class MemoryStore:
+    "Process-local state, the default; all a single worker needs"
+    def dict(self, name): return dict()
+    def setdict(self, name): return collections.defaultdict(set)
+    def listdict(self, name): return collections.defaultdict(MemoryList)
+
+class RedisDict(MutableMapping):
+    "A Redis hash of JSON values behind the `dict` interface"
+    def __init__(self, r, key): self.r, self.key = r, key
+    def __getitem__(self, k):
+        v = self.r.hget(self.key, k)
+        if v is None: raise KeyError(k)
+        return json.loads(v)
+    def __setitem__(self, k, v): self.r.hset(self.key, k, json.dumps(v))
+    def __delitem__(self, k):
+        if not self.r.hdel(self.key, k): raise KeyError(k)
+    def __contains__(self, k): return k is not None and bool(self.r.hexists(self.key, k))
+    def __iter__(self): return iter(self.r.hkeys(self.key))
+    def __len__(self): return self.r.hlen(self.key)
+    def values(self): return [json.loads(v) for v in self.r.hvals(self.key)]
+    def items(self): return [(k, json.loads(v)) for k, v in self.r.hgetall(self.key).items()]
+
+class RedisSet(MutableSet):
+    "A Redis set of strings behind the `set` interface"
+    def __init__(self, r, key): self.r, self.key = r, key
+    def add(self, v): self.r.sadd(self.key, v)
+    def discard(self, v): self.r.srem(self.key, v)
+    def __contains__(self, v): return v is not None and bool(self.r.sismember(self.key, v))
+    def __iter__(self): return iter(self.r.smembers(self.key))
+    def __len__(self): return self.r.scard(self.key)
+
+class RedisList(Sequence):
+    """
+    A Redis list of JSON values behind the `MemoryList` interface. `append`, `update` and `trim_front` are Lua scripts,
+    so several workers can share one list without mixing up indices. Items read by position are copies.
+    """
+    APPEND = "return redis.call('RPUSH', KEYS[1], ARGV[1]) - 1 + tonumber(redis.call('GET', KEYS[2]) or '0')"
+    UPDATE = """
+        local i = tonumber(ARGV[1]) - tonumber(redis.call('GET', KEYS[2]) or '0')
+        if i < 0 or i >= redis.call('LLEN', KEYS[1]) then return 0 end
+        local item = cjson.decode(redis.call('LINDEX', KEYS[1], i))
+        for k, v in pairs(cjson.decode(ARGV[2])) do item[k] = v end
+        redis.call('LSET', KEYS[1], i, cjson.encode(item))
+        return 1"""
+    TRIM_FRONT = """
+        local n = redis.call('LLEN', KEYS[1]) - tonumber(ARGV[1])
+        if n <= 0 then return {tonumber(redis.call('GET', KEYS[2]) or '0'), {}} end
+        local items = redis.call('LPOP', KEYS[1], n)
+        return {redis.call('INCRBY', KEYS[2], n) - n, items}"""
+    def __init__(self, r, key): self.r, self.key, self.dropped_key = r, key, f'{key}#dropped'
+    def __getitem__(self, i):
+        if isinstance(i, slice): return [json.loads(v) for v in self.r.lrange(self.key, 0, -1)][i]
+        v = self.r.lindex(self.key, i)
+        if v is None: raise IndexError(i)
+        return json.loads(v)
+    def __len__(self): return self.r.llen(self.key)
+    @property
+    def dropped(self): return int(self.r.get(self.dropped_key) or 0)
+    def append(self, v): return self.r.eval(self.APPEND, 2, self.key, self.dropped_key, json.dumps(v))
+    def update(self, index, **changes):
+        return bool(self.r.eval(self.UPDATE, 2, self.key, self.dropped_key, index, json.dumps(changes)))
+    def trim_front(self, keep):
+        first, items = self.r.eval(self.TRIM_FRONT, 2, self.key, self.dropped_key, keep)
+        return first, [json.loads(v) for v in items]
+
+class RedisGroup(MutableMapping):
+    "`defaultdict`-style mapping from ids to Redis sets or lists stored under `prefix:id`"
+    def __init__(self, r, prefix, cls): self.r, self.prefix, self.cls = r, prefix, cls
+    def __getitem__(self, k): return self.cls(self.r, f'{self.prefix}:{k}')
+    def __setitem__(self, k, v):
+        del self[k]
+        target = self[k]
+        for o in v:
+            if isinstance(target, RedisList): target.append(o)
+            else: target.add(o)
+    def __delitem__(self, k): self.r.delete(f'{self.prefix}:{k}', f'{self.prefix}:{k}#dropped')
+    def __contains__(self, k): return bool(self.r.exists(f'{self.prefix}:{k}'))
+    def __iter__(self):
+        return (k[len(self.prefix)+1:] for k in self.r.scan_iter(f'{self.prefix}:*') if not k.endswith('#dropped'))
+    def __len__(self): return sum(1 for _ in self)
+
+class RedisStore:
+    "State shared by every worker through one Redis (or Redis-compatible) server"
+    def __init__(self, r, prefix='fastcups'): self.r, self.prefix = r, prefix
+    def dict(self, name): return RedisDict(self.r, f'{self.prefix}:{name}')
+    def setdict(self, name): return RedisGroup(self.r, f'{self.prefix}:{name}', RedisSet)
+    def listdict(self, name): return RedisGroup(self.r, f'{self.prefix}:{name}', RedisList)
+
+def store_from_url(url=None):
+    "`None` gives a `MemoryStore`; `fakeredis://` an in-process Redis stand-in for tests; anything else goes to `redis.Redis.from_url`"
+    if not url: return MemoryStore()
+    if url.startswith('fakeredis://'):
+        import fakeredis
+        return RedisStore(fakeredis.FakeRedis(decode_responses=True))
+    import redis
+    return RedisStore(redis.Redis.from_url(url, decode_responses=True))
@@ -1,4 +1,15 @@
 import random
+import time
+import sys
+import json
+import resource
+import subprocess
+import argparse
+import queue
+import threading
+import functools
+import collections
+from concurrent.futures import Future
 import spaces
 
 import gradio as gr
@@ -11,74 +22,323 @@ from huggingface_hub import snapshot_download
 
 huggingface_token = os.getenv("HUGGINFACE_TOKEN")
 
-model_path = snapshot_download(
-    repo_id="stabilityai/stable-diffusion-3-medium", 
-    revision="refs/pr/26",
-    repo_type="model", 
-    ignore_patterns=["*.md", "*..gitattributes"],
-    local_dir="stable-diffusion-3-medium",
-    token=huggingface_token, # type a new token-id.
-    )
-
 device = "cuda" if torch.cuda.is_available() else "cpu"
 IS_SPACE = os.environ.get("SPACE_ID", None) is not None
+MERGED_PATH = os.environ.get("FLASH_SD3_MERGED_PATH", "flash-sd3-merged")
+BENCH_PROMPT = "A panda reading a book in a lush forest."
+CPU_THREADS = int(os.environ.get("FLASH_SD3_THREADS", os.cpu_count() or 1))
+CPU_COMPILE = os.environ.get("FLASH_SD3_COMPILE", "0") == "1"
+
+
+def cpu_dtype():
+    """bfloat16 where the CPU has native bf16 instructions, float32 otherwise: fp16 kernels are slow or missing on CPU."""
+    if os.environ.get("FLASH_SD3_CPU_DTYPE"):
+        return getattr(torch, os.environ["FLASH_SD3_CPU_DTYPE"])
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+    except OSError:
+        flags = set()
+    return torch.bfloat16 if flags & {"avx512_bf16", "amx_bf16", "bf16"} else torch.float32
+
+
+def default_dtype():
+    return torch.float16 if device == "cuda" else cpu_dtype()
+
+
+def download_base():
+    return snapshot_download(
+        repo_id="stabilityai/stable-diffusion-3-medium", 
+        revision="refs/pr/26",
+        repo_type="model", 
+        ignore_patterns=["*.md", "*..gitattributes"],
+        local_dir="stable-diffusion-3-medium",
+        token=huggingface_token, # type a new token-id.
+        )
 
-transformer = SD3Transformer2DModel.from_pretrained(
-    model_path,
-    subfolder="transformer",
-    torch_dtype=torch.float16,
-)
-transformer = PeftModel.from_pretrained(transformer, "jasperai/flash-sd3")
 
+def load_lora_pipeline(dtype=torch.float16):
+    """Base SD3 with the flash-sd3 LoRA kept as an unmerged adapter, paid for on every denoising step."""
+    model_path = download_base()
+    transformer = SD3Transformer2DModel.from_pretrained(
+        model_path,
+        subfolder="transformer",
+        torch_dtype=dtype,
+    )
+    transformer = PeftModel.from_pretrained(transformer, "jasperai/flash-sd3")
 
-if torch.cuda.is_available():
-    torch.cuda.max_memory_allocated(device=device)
     pipe = StableDiffusion3Pipeline.from_pretrained(
         model_path,
         transformer=transformer,
-        torch_dtype=torch.float16,
+        torch_dtype=dtype,
         text_encoder_3=None,
         tokenizer_3=None,
     )
+    pipe.scheduler = FlashFlowMatchEulerDiscreteScheduler.from_pretrained(
+      model_path,
+      subfolder="scheduler",
+    )
+    return pipe
 
-    pipe = pipe.to(device)
-else:
-    pipe = StableDiffusion3Pipeline.from_pretrained(
-        model_path,
-        transformer=transformer,
-        torch_dtype=torch.float16,
+
+def load_merged_pipeline(path=MERGED_PATH, dtype=torch.float16):
+    """The artifact written by `build_merged_pipeline`; safetensors weights are memory-mapped, nothing is downloaded."""
+    return StableDiffusion3Pipeline.from_pretrained(
+        path,
+        torch_dtype=dtype,
         text_encoder_3=None,
         tokenizer_3=None,
     )
-    pipe = pipe.to(device)
 
 
-pipe.scheduler = FlashFlowMatchEulerDiscreteScheduler.from_pretrained(
-  model_path,
-  subfolder="scheduler",
-)
+def build_merged_pipeline(path=MERGED_PATH):
+    """Folds the LoRA into the transformer weights and saves the whole pipeline, scheduler included, as safetensors."""
+    pipe = load_lora_pipeline()
+    pipe.transformer = pipe.transformer.merge_and_unload()
+    pipe.save_pretrained(path, safe_serialization=True)
+    print(f"Saved merged pipeline to {path}")
+
+
+def prepare_pipeline(pipe):
+    """Moves the pipeline to `device`; on CPU also applies the CPU serving profile."""
+    pipe = pipe.to(device)
+    if device == "cpu":
+        torch.set_num_threads(CPU_THREADS)
+        pipe.vae.to(memory_format=torch.channels_last)
+        # SD3's joint attention has no sliced processor, so VAE tiling is what bounds peak memory at 1024px
+        pipe.vae.enable_tiling()
+        if CPU_COMPILE:
+            pipe.transformer = torch.compile(pipe.transformer)
+            pipe.vae.decode = torch.compile(pipe.vae.decode)
+    return pipe
+
+
+def load_pipeline(dtype=None):
+    start = time.perf_counter()
+    dtype = dtype or default_dtype()
+    merged = os.path.isdir(MERGED_PATH)
+    pipe = load_merged_pipeline(dtype=dtype) if merged else load_lora_pipeline(dtype)
+    pipe = prepare_pipeline(pipe)
+    print(f"Loaded {'merged' if merged else 'LoRA'} pipeline ({dtype}, {device}) in {time.perf_counter() - start:.1f}s")
+    return pipe
+
+
+def time_steps(pipe, num_inference_steps=4, runs=3):
+    """Mean seconds per denoising step over `runs` generations, after one warm-up."""
+    stamps, per_step = [], []
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        stamps.append(time.perf_counter())
+        return callback_kwargs
+
+    for run in range(runs + 1):
+        stamps.clear()
+        pipe(
+            prompt=BENCH_PROMPT,
+            guidance_scale=1.0,
+            num_inference_steps=num_inference_steps,
+            generator=torch.Generator().manual_seed(0),
+            callback_on_step_end=on_step_end,
+        )
+        if run:
+            per_step.append((stamps[-1] - stamps[0]) / (len(stamps) - 1))
+    return sum(per_step) / len(per_step)
+
+
+def bench_cpu_one(size, num_inference_steps, runs=2):
+    """Seconds per image and peak RSS for one size/steps setting; run in a fresh process so the peak is its own."""
+    pipe = load_pipeline()
+    seconds = []
+    for run in range(runs + 1):
+        start = time.perf_counter()
+        pipe(
+            prompt=BENCH_PROMPT,
+            guidance_scale=1.0,
+            num_inference_steps=num_inference_steps,
+            height=size,
+            width=size,
+            generator=torch.Generator().manual_seed(0),
+        )
+        if run:
+            seconds.append(time.perf_counter() - start)
+    print(json.dumps({
+        "size": size,
+        "steps": num_inference_steps,
+        "seconds_per_image": sum(seconds) / len(seconds),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }))
+
+
+def bench_cpu(sizes=(512, 1024), steps=(4, 8)):
+    """Runs `bench_cpu_one` for every size/steps pair in its own process and prints a table."""
+    print(f"dtype {cpu_dtype()}, {CPU_THREADS} threads, torch.compile {'on' if CPU_COMPILE else 'off'}")
+    for size in sizes:
+        for num_inference_steps in steps:
+            out = subprocess.run(
+                [sys.executable, __file__, "bench-cpu", "--size", str(size), "--steps", str(num_inference_steps)],
+                capture_output=True, text=True, check=True, env={**os.environ, "CUDA_VISIBLE_DEVICES": ""},
+            ).stdout
+            r = json.loads(out.strip().splitlines()[-1])
+            print(f"{size:>5}px {num_inference_steps} steps: {r['seconds_per_image']:.1f}s/image, peak RSS {r['peak_rss_mb']:.0f}MB")
+
+
+def bench_load(num_inference_steps=4):
+    """Startup time and per-step latency of the unmerged-LoRA path and the merged artifact."""
+    if not os.path.isdir(MERGED_PATH):
+        build_merged_pipeline()
+    for name, load in [("LoRA", load_lora_pipeline), ("merged", load_merged_pipeline)]:
+        start = time.perf_counter()
+        pipe = prepare_pipeline(load(dtype=default_dtype()))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        startup = time.perf_counter() - start
+        step = time_steps(pipe, num_inference_steps)
+        print(f"{name:>6}: startup {startup:.1f}s, {1000 * step:.1f}ms/step at {num_inference_steps} steps")
+        del pipe
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
 
 MAX_SEED = np.iinfo(np.int32).max
 MAX_IMAGE_SIZE = 1024
 NUM_INFERENCE_STEPS = 4
 
 
-@spaces.GPU
-def infer(prompt, seed, randomize_seed, guidance_scale, num_inference_steps, negative_prompt, progress=gr.Progress(track_tqdm=True)):
-    if randomize_seed:
-        seed = random.randint(0, MAX_SEED)
+MAX_BATCH_SIZE = int(os.environ.get("FLASH_SD3_MAX_BATCH_SIZE", 4))
+BATCH_WAIT_MS = float(os.environ.get("FLASH_SD3_BATCH_WAIT_MS", 50))
+
+
+class MicroBatcher:
+    """Collects concurrent requests that share a key (the pipeline settings) for up to `max_wait`
+    seconds and runs them through `fn(key, items)` as one batch, handing each caller its own result."""
+
+    def __init__(self, fn, max_batch=MAX_BATCH_SIZE, max_wait=BATCH_WAIT_MS / 1000):
+        self.fn, self.max_batch, self.max_wait = fn, max_batch, max_wait
+        self.requests = queue.Queue()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, key, item):
+        future = Future()
+        self.requests.put((key, item, future))
+        return future.result()
+
+    def _loop(self):
+        waiting = collections.deque()
+        while True:
+            key, item, future = waiting.popleft() if waiting else self.requests.get()
+            batch, deadline = [(item, future)], time.monotonic() + self.max_wait
+            for request in list(waiting):
+                if len(batch) < self.max_batch and request[0] == key:
+                    waiting.remove(request)
+                    batch.append(request[1:])
+            while len(batch) < self.max_batch and (timeout := deadline - time.monotonic()) > 0:
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if request[0] == key:
+                    batch.append(request[1:])
+                else:
+                    waiting.append(request)
+            try:
+                results = list(self.fn(key, [item for item, _ in batch]))
+                if len(results) != len(batch):
+                    raise RuntimeError(f"batch of {len(batch)} returned {len(results)} results")
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+
+PROMPT_CACHE_SIZE = int(os.environ.get("FLASH_SD3_PROMPT_CACHE_SIZE", 64))
+PROMPT_CACHE_LOG_SECONDS = float(os.environ.get("FLASH_SD3_PROMPT_CACHE_LOG_SECONDS", 300))
+encode_seconds = [0.0]
+last_cache_log = [time.monotonic()]
+
+
+@functools.lru_cache(maxsize=PROMPT_CACHE_SIZE)
+def encode_prompt(prompt, negative_prompt, do_classifier_free_guidance):
+    """Text-encoder outputs for one prompt, cached: the negative prompt almost never changes and the examples repeat.
+    The guidance scale only matters through whether classifier-free guidance runs, so that is what the key holds.
+    The cache lives in the process that calls it, so it only helps local/CUDA serving: on ZeroGPU (`IS_SPACE`) every
+    `@spaces.GPU` call runs in a separate process and starts with an empty cache."""
+    start = time.perf_counter()
+    with torch.no_grad():
+        embeds = pipe.encode_prompt(
+            prompt=prompt,
+            prompt_2=None,
+            prompt_3=None,
+            device=device,
+            do_classifier_free_guidance=do_classifier_free_guidance,
+            negative_prompt=negative_prompt,
+        )
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    encode_seconds[0] += time.perf_counter() - start
+    return embeds
+
+
+def prompt_cache_stats():
+    "Hit rate and encoder time saved by `encode_prompt`'s cache in this process"
+    info = encode_prompt.cache_info()
+    mean_encode = encode_seconds[0] / (info.misses or 1)
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "hit_rate": info.hits / ((info.hits + info.misses) or 1),
+        "mean_encode_ms": 1000 * mean_encode,
+        "encode_seconds_saved": info.hits * mean_encode,
+    }
+
 
-    generator = torch.Generator().manual_seed(seed)
+@spaces.GPU
+def infer_batch(key, requests):
+    guidance_scale, num_inference_steps, height, width = key
+    prompts, negative_prompts, seeds = zip(*requests)
+    do_classifier_free_guidance = guidance_scale > 1
+
+    embeds = [
+        encode_prompt(prompt, negative_prompt if do_classifier_free_guidance else None, do_classifier_free_guidance)
+        for prompt, negative_prompt in zip(prompts, negative_prompts)
+    ]
+    prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds = (
+        None if parts[0] is None else torch.cat(parts) for parts in zip(*embeds)
+    )
 
-    image = pipe(
-        prompt=prompt,
+    images = pipe(
+        prompt_embeds=prompt_embeds,
+        negative_prompt_embeds=negative_prompt_embeds,
+        pooled_prompt_embeds=pooled_prompt_embeds,
+        negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
         guidance_scale=guidance_scale,
         num_inference_steps=num_inference_steps,
-        generator=generator,
-        negative_prompt=negative_prompt
-    ).images[0]
+        height=height,
+        width=width,
+        generator=[torch.Generator().manual_seed(seed) for seed in seeds],
+    ).images
+    if time.monotonic() - last_cache_log[0] > PROMPT_CACHE_LOG_SECONDS:
+        last_cache_log[0] = time.monotonic()
+        print("prompt cache:", prompt_cache_stats())
+    return images
+
+
+# On ZeroGPU (`IS_SPACE`) `@spaces.GPU` allocates the GPU for the Gradio request that calls it, which a background
+# thread does not carry, so there each request runs as its own batch of one from the request worker.
+batcher = None if IS_SPACE else MicroBatcher(infer_batch)
+
+
+def infer(prompt, seed, randomize_seed, guidance_scale, num_inference_steps, negative_prompt, progress=gr.Progress(track_tqdm=True)):
+    if randomize_seed:
+        seed = random.randint(0, MAX_SEED)
 
-    return image
+    key = (guidance_scale, int(num_inference_steps), MAX_IMAGE_SIZE, MAX_IMAGE_SIZE)
+    if batcher is None:
+        return infer_batch(key, [(prompt, negative_prompt, seed)])[0]
+    return batcher.submit(key, (prompt, negative_prompt, seed))
 
 
 examples = [
@@ -194,4 +454,21 @@ with gr.Blocks(css=css) as demo:
         #trigger_mode="always_last",
     )
 
-demo.queue().launch(show_api=False)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="FlashSD3 demo")
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "build-merged", "bench-load", "bench-cpu"])
+    parser.add_argument("--size", type=int, help="bench-cpu: a single image size instead of 512 and 1024")
+    parser.add_argument("--steps", type=int, help="bench-cpu: a single step count instead of 4 and 8")
+    args = parser.parse_args()
+    if args.command == "build-merged":
+        build_merged_pipeline()
+    elif args.command == "bench-load":
+        bench_load()
+    elif args.command == "bench-cpu":
+        if args.size and args.steps:
+            bench_cpu_one(args.size, args.steps)
+        else:
+            bench_cpu(sizes=(args.size,) if args.size else (512, 1024), steps=(args.steps,) if args.steps else (4, 8))
+    else:
+        pipe = load_pipeline()
+        demo.queue(default_concurrency_limit=MAX_BATCH_SIZE).launch(show_api=False)
@@ -1,9 +1,15 @@
 import torch
 import torch.nn as nn
 import re
-import torch_xla.experimental.xla_sharding as xs
-import torch_xla.core.xla_model as xm
+import math
+import functools
 from tqdm.auto import tqdm
+try:
+    import torch_xla.experimental.xla_sharding as xs
+    import torch_xla.core.xla_model as xm
+except ImportError:
+    # planning and memory estimates work without XLA; only applying a plan needs it
+    xs = xm = None
 from transformers import (
     GPTNeoXConfig, T5Config, LlamaConfig, CLIPConfig, CLIPVisionConfig, LlavaConfig, GemmaConfig, Gemma2Config,
     MistralConfig
@@ -108,37 +114,89 @@ strkey2id = {
     "sp": 3,
 }
 
-def partition_module(model, mesh, device='xla', verbose=False):
-    partition_specs = find_rule(model)
-    # rule = [(k, tuple([strkey2id.get(x) for x in v])) for k, v in partition_specs]
-        
-    # print(rule)
-    model.to(device)
+@functools.lru_cache(maxsize=None)
+def compile_rules(rules):
+    return tuple((re.compile(pattern), spec) for pattern, spec in rules)
 
-    for name, module in (tqdm(model.named_modules(), desc="partitioning model", disable=not verbose, position=0)):
+def plan_partition(model, rules=None, verbose=False):
+    """
+    Resolves the partition spec of every module weight without touching devices, so it also runs on a meta-device
+    model on CPU. Returns ({module name: spec}, [names of weights no rule matched, which stay replicated]).
+    """
+    # compile_rules is cached, so custom rules given as lists become tuples first
+    rules = compile_rules(tuple((pattern, tuple(spec)) for pattern, spec in (rules or find_rule(model))))
+    plan, unmatched = {}, []
+    for name, module in model.named_modules():
         if not hasattr(module, "weight") or not isinstance(module.weight, nn.Parameter):
             continue
-        
-        find = False
-        # print(name, module.__class__.__name__)
-        for rule_pattern, spec in partition_specs:
-            if re.findall(rule_pattern, name):
-                if verbose:
-                    print("match", rule_pattern, name, spec)
-                
-                xs.mark_sharding(module.weight, mesh, spec)
-                find = True
-                break
-            
-        if not find:
+
+        match = next(((pattern, spec) for pattern, spec in rules if pattern.search(name)), None)
+        if match is None:
             if verbose:
                 print(f"no match {module}", name, module.weight.size(), module.weight.dim())
-            xs.mark_sharding(module.weight, mesh, tuple([None] * module.weight.dim()))
+            unmatched.append(name)
+            plan[name] = tuple([None] * module.weight.dim())
+        else:
+            if verbose:
+                print("match", match[0].pattern, name, match[1])
+            plan[name] = match[1]
+    return plan, unmatched
+
+def mesh_axes(mesh):
+    "{axis name: size} from an `xs.Mesh` or an already built dict"
+    return mesh if isinstance(mesh, dict) else dict(zip(mesh.axis_names, mesh.mesh_shape))
+
+def device_bytes(model, plan, mesh):
+    "Parameter bytes each device holds under `plan`; parameters outside the plan (biases, norms) are replicated"
+    axes = mesh_axes(mesh)
+    modules = dict(model.named_modules())
+    specs = {id(modules[name].weight): spec for name, spec in plan.items()}
+    total = 0
+    for param in model.parameters():
+        shape = list(param.shape)
+        for dim, axis in enumerate(specs.get(id(param), ())):
+            if axis is None:
+                continue
+            shards = math.prod(axes.get(a, 1) for a in (axis if isinstance(axis, tuple) else (axis,)))
+            shape[dim] = -(-shape[dim] // shards)
+        total += math.prod(shape) * param.element_size()
+    return total
+
+def partition_report(model, mesh, rules=None, verbose=False):
+    """
+    Plan plus memory estimate for `mesh` (an `xs.Mesh` or e.g. {"dp": 1, "fsdp": 4, "mp": 2, "sp": 1}).
+    Build the model under `torch.device("meta")` to size a mesh without allocating or needing XLA.
+    """
+    plan, unmatched = plan_partition(model, rules, verbose=verbose)
+    report = {
+        "plan": plan,
+        "unmatched": unmatched,
+        "total_bytes": sum(p.numel() * p.element_size() for p in model.parameters()),
+        "bytes_per_device": device_bytes(model, plan, mesh),
+    }
+    if verbose:
+        print(f"{len(plan)} weights planned, {len(unmatched)} unmatched (replicated): {unmatched}")
+        print(f"{report['total_bytes'] / 2**20:.1f} MiB total, {report['bytes_per_device'] / 2**20:.1f} MiB per device "
+              f"on mesh {mesh_axes(mesh)}")
+    return report
+
+def apply_plan(model, plan, mesh, verbose=False):
+    "One pass of `mark_sharding` over a model that is already on the XLA device"
+    if xs is None:
+        raise ImportError("applying a partition plan needs torch_xla; plan_partition and partition_report work without it")
+    modules = dict(model.named_modules())
+    for name, spec in tqdm(plan.items(), desc="partitioning model", disable=not verbose, position=0):
+        xs.mark_sharding(modules[name].weight, mesh, spec)
+
+def partition_module(model, mesh, device='xla', verbose=False):
+    plan, _ = plan_partition(model, verbose=verbose)
+    model.to(device)
+    apply_plan(model, plan, mesh, verbose=verbose)
         
-def partition_module_dp(model, mesh, device=xm.xla_device(), verbose=False):
+def partition_module_dp(model, mesh, device=None, verbose=False):
     spec = (1, 2)
 
+    model.to(device or xm.xla_device())
     for name, module in model.named_modules():
-        module.to(device)
         if isinstance(module, (nn.Embedding, nn.Linear)):
             xs.mark_sharding(module.weight, mesh, spec)
@@ -0,0 +1,207 @@
+import os, sys, time, types, pytest
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('GEMINI_API_KEY', 'test')
+import fastcups
+
+@pytest.fixture(autouse=True)
+def archive_folder(tmp_path, monkeypatch):
+    monkeypatch.setitem(fastcups.app.config, 'ARCHIVE_FOLDER', str(tmp_path))
+
+class StubChat:
+    def __init__(self, latency): self.latency = latency
+    def send_message(self, question, stream=False, request_options=None):
+        time.sleep(self.latency)
+        yield types.SimpleNamespace(text=f"answer to {question}")
+
+def stub_model(latency):
+    return types.SimpleNamespace(start_chat=lambda history: StubChat(latency))
+
+def with_slides(*class_ids):
+    fastcups.name2file['files/test'] = 'slides'
+    for class_id in class_ids: fastcups.class2slides[class_id] = 'files/test'
+
+def wait_answered(class_id, index, timeout=5):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if fastcups.class2questions[class_id][index]['answer_status'] != 'pending': return True
+        time.sleep(0.01)
+    return False
+
+def test_busy_class_does_not_hold_up_other_classes(monkeypatch):
+    monkeypatch.setattr(fastcups, 'answer_pool', ThreadPoolExecutor(2))
+    monkeypatch.setattr(fastcups, 'ANSWERS_PER_CLASS', 1)
+    monkeypatch.setattr(fastcups, 'model', stub_model(0.5))
+    with_slides('fair-a', 'fair-b')
+    client = fastcups.socketio.test_client(fastcups.app, headers={'Cookie': 'student_id=fair'})
+    for q in ['first', 'second', 'third']: client.emit('submit_question', 'fair-a', f'{q} question about a')
+    start = time.monotonic()
+    client.emit('submit_question', 'fair-b', 'a question about b')
+    assert wait_answered('fair-b', 0)
+    assert time.monotonic() - start < 1.0
+    for i in range(3): assert wait_answered('fair-a', i)
+    client.disconnect()
+    for class_id in ['fair-a', 'fair-b']: fastcups.evict_class(class_id)
+
+def gemini_upload(name, expires_in, state='ACTIVE'):
+    import datetime
+    expiration = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=expires_in)
+    return types.SimpleNamespace(name=name, display_name=name, expiration_time=expiration, state=types.SimpleNamespace(name=state))
+
+def test_deduped_slides_are_not_reused_once_expiring_or_gone(monkeypatch):
+    uploads = {'files/fresh': gemini_upload('files/fresh', 40 * 3600), 'files/old': gemini_upload('files/old', 3600),
+               'files/failed': gemini_upload('files/failed', 40 * 3600, state='FAILED')}
+    monkeypatch.setattr(fastcups.genai, 'get_file', lambda name: uploads[name])
+    for name, file in uploads.items(): fastcups.sha2file[name] = file
+    assert fastcups.reusable_slides('files/fresh') is uploads['files/fresh']
+    assert fastcups.reusable_slides('files/old') is None
+    assert fastcups.reusable_slides('files/failed') is None
+    assert 'files/old' not in fastcups.sha2file and 'files/failed' not in fastcups.sha2file
+    fastcups.sha2file['files/old'] = uploads['files/old']
+    fastcups.evict_idle(0)
+    assert list(fastcups.sha2file) == ['files/fresh']
+    fastcups.sha2file.clear()
+
+OPPOSITE_QUESTIONS = [("Why is the complexity quadratic?", "Why is the complexity not quadratic?"),
+                      ("Why is the complexity quadratic?", "Why isn't the complexity quadratic?"),
+                      ("What is the max of the list?", "What is the min of the list?"),
+                      ("When do we use a tree?", "When do we use a trie?"),
+                      ("What is on slide 3?", "What is on slide 4?"),
+                      ("Is A faster than B?", "Is B faster than A?"),
+                      ("Why does x depend on y?", "Why does y depend on x?")]
+
+@pytest.mark.parametrize('fuzzy', [False, True])
+def test_opposite_questions_never_share_an_answer(monkeypatch, fuzzy):
+    monkeypatch.setattr(fastcups, 'FUZZY_QUESTIONS', fuzzy)
+    for a, b in OPPOSITE_QUESTIONS: assert fastcups.question_key(a) != fastcups.question_key(b), (a, b)
+
+def test_question_coalescing(monkeypatch):
+    assert fastcups.question_key("What is X?") == fastcups.question_key("what is  x")
+    assert fastcups.question_key("Why is the complexity quadratic?") != fastcups.question_key("why is complexity quadratic")
+    monkeypatch.setattr(fastcups, 'FUZZY_QUESTIONS', True)
+    assert fastcups.question_key("Why is the complexity quadratic?") == fastcups.question_key("why is complexity quadratic")
+
+def redis_store(server=None):
+    fakeredis = pytest.importorskip('fakeredis')
+    from fastcups_state import RedisStore
+    return RedisStore(fakeredis.FakeRedis(server=server or fakeredis.FakeServer(), decode_responses=True))
+
+@pytest.fixture(params=['memory', 'fakeredis'])
+def store(request):
+    from fastcups_state import MemoryStore
+    return MemoryStore() if request.param == 'memory' else redis_store()
+
+def test_store_dict_and_set_semantics(store):
+    d, groups = store.dict('d'), store.setdict('s')
+    d['a'] = {'x': 1}
+    assert d['a'] == {'x': 1} and 'a' in d and None not in d and d.get('b') is None and len(d) == 1
+    assert dict(d.items()) == {'a': {'x': 1}} and list(d.values()) == [{'x': 1}]
+    assert d.pop('a') == {'x': 1} and d.pop('a', None) is None and len(d) == 0
+    groups['c'].add('s1'); groups['c'].add('s2'); groups['c'].discard('s1')
+    assert set(groups['c']) == {'s2'} and 's2' in groups['c'] and len(groups['c']) == 1
+    assert list(groups) == ['c'] and 'c' in groups and 'other' not in groups
+    groups.pop('c', None)
+    assert 'c' not in groups and list(groups) == []
+
+def test_store_list_keeps_indices_stable(store):
+    groups = store.listdict('q')
+    questions = groups['c']
+    assert [questions.append({'n': i}) for i in range(5)] == [0, 1, 2, 3, 4]
+    assert questions.update(3, status='solved', answer=None) and not questions.update(7, status='solved')
+    assert questions.trim_front(2) == (0, [{'n': 0}, {'n': 1}, {'n': 2}])
+    assert questions.trim_front(2) == (3, []) and questions.dropped == 3
+    assert questions.append({'n': 5}) == 5 and not questions.update(1, status='solved')
+    assert questions.update(5, status='solved')
+    assert list(questions) == [{'n': 3, 'status': 'solved', 'answer': None}, {'n': 4}, {'n': 5, 'status': 'solved'}]
+    assert list(groups) == ['c'] and len(groups['c']) == 3
+
+def test_workers_sharing_a_store_get_distinct_question_indices():
+    fakeredis = pytest.importorskip('fakeredis')
+    server = fakeredis.FakeServer()
+    workers = [redis_store(server).listdict('q')['c'] for _ in range(4)]
+    with ThreadPoolExecutor(8) as pool:
+        indices = list(pool.map(lambda i: workers[i % 4].append({'n': i}), range(200)))
+        list(pool.map(lambda i: workers[i % 4].trim_front(50), range(8)))
+    assert sorted(indices) == list(range(200))
+    n_by_index = {index: n for n, index in enumerate(indices)}
+    assert workers[0].dropped == 150 and [q['n'] for q in workers[1]] == [n_by_index[i] for i in range(150, 200)]
+    assert all(workers[0].update(i, status='solved') for i in range(150, 200))
+    assert not workers[0].update(149, status='solved')
+
+def test_questions_in_a_shared_store(monkeypatch):
+    monkeypatch.setattr(fastcups, 'class2questions', redis_store().listdict('class2questions'))
+    monkeypatch.setattr(fastcups, 'MAX_QUESTIONS_PER_CLASS', 4)
+    client = fastcups.socketio.test_client(fastcups.app, headers={'Cookie': 'student_id=shared'})
+    client.emit('register_student', time.time(), 'shared')
+    for i in range(5): client.emit('submit_question', 'shared', f'question {i}')
+    assert [q['question'] for q in fastcups.class2questions['shared']] == ['question 3', 'question 4']
+    client.emit('mark_question_solved', 'shared', 4)
+    client.emit('mark_question_solved', 'shared', 1)
+    assert [q['status'] for q in fastcups.class2questions['shared']] == ['pending', 'solved']
+    updates = [e['args'][0] for e in client.get_received() if e['name'] == 'question_status_update']
+    assert updates == [{'index': 4, 'status': 'solved'}]
+    client.disconnect()
+    fastcups.evict_class('shared')
+
+def test_answer_cache_keeps_most_recently_used_answers(monkeypatch):
+    monkeypatch.setattr(fastcups, 'ANSWER_CACHE_PER_CLASS', 2)
+    with fastcups.coalesce_lock:
+        for key in ['a', 'b']: fastcups.cache_answer('lru', key, key.upper())
+        fastcups.class2answer_cache['lru'].move_to_end('a')
+        fastcups.cache_answer('lru', 'c', 'C')
+    assert dict(fastcups.class2answer_cache['lru']) == {'a': 'A', 'c': 'C'}
+    fastcups.evict_class('lru')
+
+def test_only_the_archive_worker_trims_and_evicts_questions(monkeypatch, tmp_path):
+    monkeypatch.setattr(fastcups, 'MAX_QUESTIONS_PER_CLASS', 4)
+    monkeypatch.setattr(fastcups, 'ARCHIVE_WORKER', False)
+    client = fastcups.socketio.test_client(fastcups.app, headers={'Cookie': 'student_id=archive'})
+    for i in range(6): client.emit('submit_question', 'archive', f'question {i}')
+    client.disconnect()
+    fastcups.evict_idle(time.time() + 1)
+    assert len(fastcups.class2questions['archive']) == 6 and not list(tmp_path.iterdir())
+    monkeypatch.setattr(fastcups, 'ARCHIVE_WORKER', True)
+    fastcups.evict_idle(0)
+    assert [q['question'] for q in fastcups.class2questions['archive']] == ['question 4', 'question 5']
+    fastcups.evict_class('archive')
+    assert 'archive' not in fastcups.class2questions and list(tmp_path.iterdir())
+
+def test_question_without_slides_is_answered_no_slides():
+    client = fastcups.socketio.test_client(fastcups.app, headers={'Cookie': 'student_id=noslides'})
+    client.emit('register_student', time.time(), 'noslides')
+    client.emit('submit_question', 'noslides', 'anything?')
+    ready = [e['args'][0] for e in client.get_received() if e['name'] == 'answer_ready']
+    assert ready == [{'index': 0, 'answer': None, 'answer_status': 'no_slides'}]
+    assert fastcups.class2questions['noslides'][0]['answer_status'] == 'no_slides'
+    client.disconnect()
+    fastcups.evict_class('noslides')
+
+def test_repeated_questions_share_one_gemini_call(monkeypatch):
+    monkeypatch.setattr(fastcups, 'model', stub_model(0.2))
+    with_slides('repeat')
+    client = fastcups.socketio.test_client(fastcups.app, headers={'Cookie': 'student_id=repeat'})
+    client.emit('register_student', time.time(), 'repeat')
+    client.emit('submit_question', 'repeat', 'What is X?')
+    client.emit('submit_question', 'repeat', 'what is x')
+    assert wait_answered('repeat', 0) and wait_answered('repeat', 1)
+    client.emit('submit_question', 'repeat', 'What is X')
+    assert wait_answered('repeat', 2)
+    s = fastcups.class2stats['repeat']
+    assert (s['llm_calls'], s['answers_coalesced'], s['answers_cached']) == (1, 1, 1)
+    assert {q['answer'] for q in fastcups.class2questions['repeat']} == {'answer to What is X?'}
+    client.disconnect()
+    fastcups.evict_class('repeat')
+
+def test_cached_answers_are_not_reused_after_another_worker_changes_slides(monkeypatch):
+    monkeypatch.setattr(fastcups, 'model', stub_model(0))
+    with_slides('deck')
+    client = fastcups.socketio.test_client(fastcups.app, headers={'Cookie': 'student_id=deck'})
+    client.emit('submit_question', 'deck', 'What is X?')
+    assert wait_answered('deck', 0)
+    fastcups.name2file['files/new'] = 'new slides'
+    fastcups.class2slides['deck'] = 'files/new'  # as another worker's upload would, without clearing this cache
+    client.emit('submit_question', 'deck', 'What is X?')
+    assert wait_answered('deck', 1)
+    assert fastcups.class2stats['deck']['llm_calls'] == 2 and not fastcups.class2stats['deck']['answers_cached']
+    client.disconnect()
+    fastcups.evict_class('deck')